@@ -1,162 +1,247 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import os
 import pwd
 import stat
-
-def get_cmd_user(pid):
-    """Retrieves the command and user for a given pid,
-    returning (command, user)
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# user names for uids already looked up, so that the user database is only
+# consulted once per uid
+# NOTE: the cache is shared between the worker threads of lsof(); racing on a
+# miss just means the same value is computed and stored twice
+_uid_name_cache = {}
+
+def get_user_name(uid):
+    """Returns the name of the user with the given uid, or the uid itself
+    (as a string) if no such user exists
     """
-    with open('/proc/{}/stat'.format(pid)) as stat_file:
-        # command is the second entry in the stat file, enclosed in parentheses
-        cmd = stat_file.readline().split()[1][1:-1]
-    with open('/proc/{}/status'.format(pid)) as status_file:
-        for ln in status_file:
-            if ln.startswith('Uid:'):
-                # grab the number after 'Uid:'
-                uid = int(ln.split()[1])
-                user = pwd.getpwuid(uid).pw_name
-    return (cmd, user)
-
-
-class FileInfo(object):
-    """Contains information about a file open in a specific process:
-        *pid - pid of the process
-        *cmd - command
-        *usr - user running the process
-        *fd - file descriptor within the process, or one of the predefined
-            placeholders
-        *type - type of the file (e.g. directory, regular, pipe, etc.)
-        *dev - device on which the file resides
-        *size - size or offset of the file, depending on type
-        *node - inode of the file
-        *name - name of the file
+    try:
+        return _uid_name_cache[uid]
+    except KeyError:
+        pass
+    try:
+        name = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        name = str(uid)
+    _uid_name_cache[uid] = name
+    return name
+
+def read_proc_file(path, dir_fd=None, whole=False):
+    """Returns the contents of a procfs file. As with os.open, a relative path
+    is looked up in dir_fd if it is given.
+    Small files (like stat and status) fit in a single read(). procfs hands out
+    at most about a page per read(), so larger files need whole=True, which
+    keeps reading until end of file.
     """
-    def __init__(self, pid, fd, type, dev, size, node, name):
-        """Initializes with the given information. Command/user are inferred
-        from the PID.
-        """
-        self.pid = pid
-        self.cmd, self.usr = get_cmd_user(pid)
-        self.fd = fd
-        self.type = type
-        self.dev = dev
-        self.size = size
-        self.node = node
-        self.name = name
+    fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+    try:
+        if not whole:
+            return os.read(fd, 4096)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+def get_cmd_user(proc_fd):
+    """Retrieves the command and user for the process whose /proc directory is
+    open as proc_fd, returning (command, user)
+    """
+    data = read_proc_file('stat', proc_fd)
+    # command is the second entry in the stat file, enclosed in parentheses
+    # (it may contain spaces and parentheses itself)
+    cmd = os.fsdecode(data[data.index(b'(') + 1:data.rindex(b')')])
+    data = read_proc_file('status', proc_fd)
+    # grab the (real) uid, the first of the tab-separated numbers after 'Uid:'
+    start = data.index(b'\nUid:\t') + 6
+    uid = int(data[start:data.index(b'\t', start)])
+    return (cmd, get_user_name(uid))
+
+# lsof type names for the file types we know about
+_file_types = {
+    stat.S_IFREG: 'REG',
+    stat.S_IFDIR: 'DIR',
+    stat.S_IFCHR: 'CHR',
+    stat.S_IFIFO: 'FIFO',
+}
 
 def get_type(stat_obj):
     """Returns the type of the file based on its stats"""
-    mode = stat_obj.st_mode
-    if stat.S_ISREG(mode):
-        return 'REG'
-    if stat.S_ISDIR(mode):
-        return 'DIR'
-    if stat.S_ISCHR(mode):
-        return 'CHR'
-    if stat.S_ISFIFO(mode):
-        return 'FIFO'
-    return 'unknown'
+    return _file_types.get(stat.S_IFMT(stat_obj.st_mode), 'unknown')
 
 def fmt_dev(stat, use_rdev):
     """Returns a device name from the st_dev field in stat, or st_rdev if
     use_rdev is True
     """
-    if use_rdev:
-        return str(os.major(stat.st_rdev)) + ',' + str(os.minor(stat.st_rdev))
-    return str(os.major(stat.st_dev)) + ',' + str(os.minor(stat.st_dev))
+    dev = stat.st_rdev if use_rdev else stat.st_dev
+    return f'{os.major(dev)},{os.minor(dev)}'
 
-def read_fd(pid, fd, path, use_rdev = False):
-    """Reads information about the file descriptor open in the given process"""
+def read_fd(fd, path, dir_fd, dir_path, use_rdev = False):
+    """Reads information about the file descriptor open in a process, given
+    the path of its /proc link relative to dir_fd (which is the directory
+    dir_path). Returns a tuple of:
+        *fd - file descriptor within the process, or one of the predefined
+            placeholders
+        *type - type of the file (e.g. directory, regular, pipe, etc.)
+        *dev - device on which the file resides
+        *size - size or offset of the file, depending on type
+        *node - inode of the file
+        *name - name of the file
+    """
     try:
-        real_path = os.readlink(path)
+        # readlink comes first: it is all pipes, sockets and anonymous inodes
+        # need, and files on disk need both calls anyway (stat goes through the
+        # magic link, so that doesn't walk the target's path)
+        # NOTE: os.readlink reads into a PATH_MAX-sized buffer, so this is a
+        # single syscall however long the target is
+        real_path = os.readlink(path, dir_fd=dir_fd)
+        # files on disk are by far the most common case, so they are checked
+        # first and everything else is left to the slower path below
         if real_path[0] == '/':  # assume that all paths are absolute
-            stat = os.stat(real_path)
-            return FileInfo(pid, fd, get_type(stat), fmt_dev(stat, use_rdev),
-                stat.st_size, stat.st_ino, real_path)
-        else:
-            type, name = real_path.split(':')
-            if type == 'anon_inode':
-                return FileInfo(pid, fd, 'a_inode', '', '0', '', name)
-            if type == 'socket':
-                return FileInfo(pid, fd, 'socket', name[1:-1], '0', '', '')
-            if type == 'pipe':
-                return FileInfo(pid, fd, 'FIFO', '', '', '', 'pipe')
+            # stat the magic link itself rather than walking `real_path` again;
+            # this also works for deleted files and processes in a chroot
+            stat = os.stat(path, dir_fd=dir_fd)
+            return (fd, get_type(stat), fmt_dev(stat, use_rdev), stat.st_size,
+                stat.st_ino, real_path)
+        type, _, name = real_path.partition(':')
+        if type == 'socket':
+            return (fd, 'socket', name[1:-1], '0', '', '')
+        if type == 'pipe':
+            return (fd, 'FIFO', '', '', '', 'pipe')
+        if type == 'anon_inode':
+            return (fd, 'a_inode', '', '0', '', name)
+        # something else entirely (e.g. a namespace)
+        return (fd, 'unknown', '', '', '', real_path)
     except OSError as e:
-        return FileInfo(pid, 'NOFD', 'unknown', '', '', '',
-            '{} (error: {})'.format(path, e.strerror))
+        return ('NOFD', 'unknown', '', '', '',
+            f'{dir_path}/{path} (error: {e.strerror})')
 
-def get_proc_fds(pid):
+def get_proc_fds(proc_fd, proc_dir):
     """Returns all open files found in the process's `fd` directory"""
-    fd_dir_path = '/proc/{}/fd'.format(pid)
+    fd_dir_path = proc_dir + '/fd'
     ret = []
     try:
-        for fd in os.listdir(fd_dir_path):
-            ret.append(read_fd(pid, fd, '/proc/{}/fd/{}'.format(pid, fd), True))
+        fd_dir = os.open('fd', os.O_RDONLY | os.O_DIRECTORY, dir_fd=proc_fd)
+        try:
+            with os.scandir(fd_dir) as entries:
+                for entry in entries:
+                    ret.append(read_fd(entry.name, entry.name, fd_dir,
+                        fd_dir_path, True))
+        finally:
+            os.close(fd_dir)
     except OSError as e:
         # just return one entry describing the error
-        return [FileInfo(pid, 'NOFD', 'unknown', '', '', '',
-            '{} (error: {})'.format(fd_dir_path, e.strerror))]
+        return [('NOFD', 'unknown', '', '', '',
+            f'{fd_dir_path} (error: {e.strerror})')]
     return ret
 
-def get_proc_cwd(pid):
+def get_proc_cwd(proc_fd, proc_dir):
     """Returns info about the process's current working directory"""
-    return read_fd(pid, 'cwd', '/proc/{}/cwd'.format(pid))
+    return read_fd('cwd', 'cwd', proc_fd, proc_dir)
 
-def get_proc_root(pid):
+def get_proc_root(proc_fd, proc_dir):
     """Returns info about the process's root directory"""
-    return read_fd(pid, 'rtd', '/proc/{}/root'.format(pid))
+    return read_fd('rtd', 'root', proc_fd, proc_dir)
 
-def get_proc_txt(pid):
+def get_proc_txt(proc_fd, proc_dir):
     """Returns info about the process's executable file"""
-    return read_fd(pid, 'txt', '/proc/{}/exe'.format(pid))
+    return read_fd('txt', 'exe', proc_fd, proc_dir)
 
-def get_proc_maps(pid):
-    """Returns info about the memory-mapped files in this process"""
+def get_proc_maps(proc_fd):
+    """Returns info about the memory-mapped files in this process, listing each
+    file once even if it is mapped several times (like lsof does)
+    """
     def htod(hex):
         """Converts a hex string to a decimal string"""
         return str(int(hex, 16))
 
     ret = []
+    seen = set()
     try:
-        with open('/proc/{}/maps'.format(pid)) as maps:
-            for line in maps:
-                parts = line.split()
-                offset = parts[2]
-                dev = parts[3]
-                inode = parts[4]
-                # some entries are anonymous (??)
-                name = parts[5] if len(parts) > 5 else '[blah]'
-                if name[0] != '/':
-                    # pseudo-paths (parts of the elf binary + stack, heap, etc.)
-                    continue
-                # NOTE: this hard-coded type is probably wrong
-                ret.append(FileInfo(pid, 'mem', 'REG',
-                ','.join(map(htod, dev.split(':'))), htod(offset), inode, name))
+        for line in read_proc_file('maps', proc_fd, True).splitlines():
+            if b' /' not in line:
+                # cheap check that rules out most anonymous entries and
+                # pseudo-paths (parts of the elf binary + stack, heap, etc.)
+                continue
+            _, _, offset, dev, inode, name = line.split(None, 5)
+            if not name.startswith(b'/'):
+                # pseudo-paths that happen to contain ' /', e.g. named
+                # anonymous mappings like '[anon:cache /x]'
+                continue
+            if (dev, inode) in seen:
+                # another segment of a file we already have
+                continue
+            seen.add((dev, inode))
+            # NOTE: this hard-coded type is probably wrong
+            ret.append(('mem', 'REG', ','.join(map(htod, dev.split(b':'))),
+                htod(offset), inode.decode(), os.fsdecode(name)))
     except:
         # this appears to be consistent with lsof
         return []
     return ret
 
-def get_proc_files(pid):
-    """Returns a list of *all* open files in the process"""
-    return ([get_proc_cwd(pid)] + [get_proc_root(pid)] + [get_proc_txt(pid)]
-        + get_proc_maps(pid) + get_proc_fds(pid))
+def get_proc_files(proc_fd, proc_dir):
+    """Returns a list of *all* open files in the process whose /proc directory
+    (proc_dir) is open as proc_fd
+    """
+    return ([get_proc_cwd(proc_fd, proc_dir)]
+        + [get_proc_root(proc_fd, proc_dir)]
+        + [get_proc_txt(proc_fd, proc_dir)] + get_proc_maps(proc_fd)
+        + get_proc_fds(proc_fd, proc_dir))
+
+def get_proc_info(pid):
+    """Returns ((command, pid, user), files) for the given pid, where files is
+    a list of all files open in the process. The first tuple is shared by all of
+    the process's files rather than being repeated in each of them.
+    Returns None if the process has exited.
+    """
+    proc_dir = f'/proc/{pid}'
+    # the process may exit at any point after its pid was listed; like lsof,
+    # just leave it out then
+    try:
+        # everything is looked up relative to the process's directory, so that
+        # its path only needs to be resolved once
+        proc_fd = os.open(proc_dir, os.O_PATH | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return None
+    try:
+        cmd, usr = get_cmd_user(proc_fd)
+        # many processes run the same command
+        return ((sys.intern(cmd), pid, usr), get_proc_files(proc_fd, proc_dir))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    finally:
+        os.close(proc_fd)
+
+def get_pids():
+    """Returns a list of the pids of all running processes"""
+    with os.scandir('/proc') as entries:
+        return [entry.name for entry in entries
+            if entry.name[0].isdigit() and entry.name.isdigit()]
 
 def lsof():
     """Prints list of open files"""
-    fmt = "{:21} {:>5}   {:>10} {:>4} {:>9} {:>18} {:>9} {:>10} {}"
+    fmt = "%-21s %5s   %10s %4s %9s %18s %9s %10s %s\n"
+    # names that aren't valid in the filesystem encoding come out of os.fsdecode
+    # and os.readlink with surrogate escapes; write their original bytes back
+    sys.stdout.reconfigure(errors='surrogateescape')
     # headings
-    print fmt.format('COMMAND', 'PID', 'USER', 'FD', 'TYPE', 'DEVICE',
-        'SIZE/OFF', 'NODE', 'NAME')
-    for pid in os.listdir('/proc'):
-        if not pid.isdigit():
-            continue  # not a pid
-        for file_info in get_proc_files(pid):
-            print fmt.format(file_info.cmd, file_info.pid, file_info.usr,
-                file_info.fd, file_info.type, file_info.dev, file_info.size,
-                file_info.node, file_info.name)
+    sys.stdout.write(fmt % ('COMMAND', 'PID', 'USER', 'FD', 'TYPE', 'DEVICE',
+        'SIZE/OFF', 'NODE', 'NAME'))
+    # the scan is dominated by blocking procfs I/O, which releases the GIL, so
+    # processes are scanned in parallel (but still printed in order)
+    with ThreadPoolExecutor((os.cpu_count() or 1) * 4) as pool:
+        for proc_info in pool.map(get_proc_info, get_pids()):
+            if proc_info is None:
+                continue  # process has exited
+            proc, proc_files = proc_info
+            # write each process's files in one go rather than line by line
+            sys.stdout.write(''.join([fmt % (proc + info)
+                for info in proc_files]))
 
 if __name__ == '__main__':
     lsof()